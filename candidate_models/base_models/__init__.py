@@ -4,23 +4,29 @@ import os
 from importlib import import_module
 
 import functools
-import numpy as np
 
 from brainscore.utils import LazyLoad, fullname
 from candidate_models import s3
-from model_tools.activations import PytorchWrapper, KerasWrapper
+from candidate_models.base_models.pytorch import PytorchWrapper
+from model_tools.activations import KerasWrapper
 from brainscore.submission.utils import UniqueKeyDict
 from model_tools.activations.tensorflow import TensorflowWrapper, TensorflowSlimWrapper
 
 _logger = logging.getLogger(__name__)
 
 
-def torchvision_model(identifier, image_size):
+def torchvision_model(identifier, image_size, batched_preprocessing=False):
     module = import_module(f'torchvision.models')
     model_ctr = getattr(module, identifier)
-    from model_tools.activations.pytorch import load_preprocess_images
+    if batched_preprocessing:
+        # activations differ slightly from the model-tools preprocessing and are thus stored under their own identifier
+        from candidate_models.base_models.pytorch import load_preprocess_images
+        identifier = f"{identifier}-batched"
+    else:
+        from model_tools.activations.pytorch import load_preprocess_images
     preprocessing = functools.partial(load_preprocess_images, image_size=image_size)
-    wrapper = PytorchWrapper(identifier=identifier, model=model_ctr(pretrained=True), preprocessing=preprocessing)
+    wrapper = PytorchWrapper(identifier=identifier, model=model_ctr(pretrained=True), preprocessing=preprocessing,
+                             channels_last=True)
     wrapper.image_size = image_size
     return wrapper
 
@@ -306,7 +312,7 @@ def GoN_model(function, train, image_size):
     # process weights -- remove the attacker and prepocessing weights
     model.load_state_dict(checkpoint['model_state_dict'])
     # wrap model with pytorch wrapper
-    wrapper = PytorchWrapper(identifier=weights_id, model=model, preprocessing=preprocessing)
+    wrapper = PytorchWrapper(identifier=weights_id, model=model, preprocessing=preprocessing, channels_last=True)
     wrapper.image_size = image_size
     return wrapper
 
@@ -347,7 +353,7 @@ def robust_model(function, penalty, eps, image_size):
     weights = {k: weights[k] for k in list(weights.keys())[2:]}
     model.load_state_dict(weights)
     # wrap model with pytorch wrapper
-    wrapper = PytorchWrapper(identifier=weights_id, model=model, preprocessing=preprocessing)
+    wrapper = PytorchWrapper(identifier=weights_id, model=model, preprocessing=preprocessing, channels_last=True)
     wrapper.image_size = image_size
     return wrapper
 
@@ -366,6 +372,7 @@ def wsl(c_size):
 
 
 def fixres(model_identifier, model_url):
+    import torch
     # model
     from fixres.hubconf import load_state_dict_from_url
     module = import_module('fixres.imnet_evaluate.resnext_wsl')
@@ -396,9 +403,7 @@ def fixres(model_identifier, model_url):
 
     def load_preprocess_images(image_filepaths):
         images = load_images(image_filepaths)
-        images = [transform(image) for image in images]
-        images = [image.unsqueeze(0) for image in images]
-        images = np.concatenate(images)
+        images = torch.stack([transform(image) for image in images])
         return images
 
     wrapper = PytorchWrapper(identifier=model_identifier, model=model, preprocessing=load_preprocess_images,
@@ -419,6 +424,17 @@ def unsupervised_vvs_model(identifier):
     return build(identifier)
 
 
+# pool identifier -> torchvision identifier of the models that are also registered with batched preprocessing
+BATCHED_PREPROCESSING_MODELS = {
+    'alexnet': 'alexnet',
+    'vgg-16-pt': 'vgg16',
+    'resnet-18-pt': 'resnet18',
+    'resnet-50-pt': 'resnet50',
+    'resnet-101-pt': 'resnet101',
+    'densenet-121-pt': 'densenet121',
+}
+
+
 class BaseModelPool(UniqueKeyDict):
     """
     Provides a set of standard models.
@@ -567,6 +583,12 @@ class BaseModelPool(UniqueKeyDict):
                     identifier, preprocessing_type='inception', image_size=image_size, net_name=net_name,
                     model_ctr_kwargs={'depth_multiplier': multiplier})
 
+        # opt-in batched preprocessing on the model device, see `candidate_models.base_models.pytorch`
+        for identifier, torchvision_identifier in BATCHED_PREPROCESSING_MODELS.items():
+            _key_functions[f"{identifier}-batched"] = \
+                lambda torchvision_identifier=torchvision_identifier: torchvision_model(
+                    torchvision_identifier, image_size=224, batched_preprocessing=True)
+
         # instantiate models with LazyLoad wrapper
         for identifier, function in _key_functions.items():
             self[identifier] = LazyLoad(function)
@@ -28,7 +28,10 @@ def package(features_path='/braintree/data2/active/users/qbilius/computed/hvm/ai
     hvm_ids = hvm['image_id'].values.tolist()
 
     assert len(hvm_ids) == len(meta_ids)
-    indexes = [meta_ids.index(id) for id in hvm_ids]
+    meta_indexes = {}
+    for index, id in enumerate(meta_ids):
+        meta_indexes.setdefault(id, index)  # first occurrence, like `list.index`
+    indexes = [meta_indexes[id] for id in hvm_ids]
 
     basenets = []
     for activations_path_v4 in glob.glob(os.path.join(features_paths[0], '*.npy')):
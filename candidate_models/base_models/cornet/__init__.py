@@ -12,7 +12,7 @@ from brainio_base.assemblies import merge_data_arrays, NeuroidAssembly, walk_coo
 from candidate_models import s3
 from candidate_models.base_models.cornet.cornet_r2 import fix_state_dict_naming as fix_r2_state_dict_naming
 from model_tools.activations.core import ActivationsExtractorHelper
-from model_tools.activations.pytorch import PytorchWrapper
+from candidate_models.base_models.pytorch import PytorchWrapper
 
 _logger = logging.getLogger(__name__)
 
@@ -80,6 +80,8 @@ def cornet(identifier, separate_time=True):
 class TemporalPytorchWrapper(PytorchWrapper):
     def __init__(self, *args, separate_time=True, **kwargs):
         self._separate_time = separate_time
+        self._layer_counter = defaultdict(lambda: 0)
+        self._layer_hooks = {}  # layer name without timestep -> hook handle shared by all its timesteps
         super(TemporalPytorchWrapper, self).__init__(*args, **kwargs)
 
     def _build_extractor(self, *args, **kwargs):
@@ -91,16 +93,27 @@ class TemporalPytorchWrapper(PytorchWrapper):
     def get_activations(self, images, layer_names):
         # reset
         self._layer_counter = defaultdict(lambda: 0)
-        self._layer_hooks = {}
         return super(TemporalPytorchWrapper, self).get_activations(images=images, layer_names=layer_names)
 
+    def _detach_hooks(self):
+        super(TemporalPytorchWrapper, self)._detach_hooks()
+        self._layer_hooks = {}
+
+    def _missing_layers(self, layer_names):
+        # outputs are recorded per timestep, e.g. `logits` is recorded as `logits-t0`
+        recorded_layers = set(self._layer_results) | \
+                          set(self._strip_layer_timestep(layer_name) for layer_name in self._layer_results)
+        return [layer_name for layer_name in layer_names if layer_name not in recorded_layers]
+
     def register_hook(self, layer, layer_name, target_dict):
         layer_name = self._strip_layer_timestep(layer_name)
         if layer_name in self._layer_hooks:  # add hook only once for multiple timesteps
             return self._layer_hooks[layer_name]
 
         def hook_function(_layer, _input, output):
-            target_dict[f"{layer_name}-t{self._layer_counter[layer_name]}"] = PytorchWrapper._tensor_to_numpy(output)
+            if not self._recording:
+                return
+            target_dict[f"{layer_name}-t{self._layer_counter[layer_name]}"] = self._tensor_to_host(output)
             self._layer_counter[layer_name] += 1
 
         hook = layer.register_forward_hook(hook_function)
@@ -0,0 +1,358 @@
+import functools
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from model_tools.activations.pytorch import PytorchWrapper as _PytorchWrapper, load_image, SUBMODULE_SEPARATOR
+
+_logger = logging.getLogger(__name__)
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+class PytorchWrapper(_PytorchWrapper):
+    """
+    Drop-in replacement for the `model_tools` `PytorchWrapper`.
+    Besides numpy batches as produced by the `model_tools` preprocessing that all base models use by default, it also
+    accepts batches which were already preprocessed into a single tensor on the model device, as done by
+    `load_preprocess_images` below for the opt-in `-batched` base models.
+    Forward hooks are registered once per set of requested layers and kept across calls rather than being re-attached
+    for every batch. They only record during `get_activations` and ignore any other forward pass of the model; call
+    `remove_hooks` once done with the wrapper to hand back a hook-free model.
+    """
+
+    def __init__(self, *args, channels_last=False, autocast_dtype=None, torch_compile=False, **kwargs):
+        """
+        :param channels_last: run the model and its inputs in the NHWC `torch.channels_last` memory format which
+            cuDNN/oneDNN convolutions are fastest in. Only safe for models that do not `.view` spatial feature maps.
+        :param autocast_dtype: if set (`torch.float16` on CUDA, or `torch.bfloat16`), run the forward pass under
+            `torch.autocast` with this dtype. Weights stay in float32 and activations are returned as float32, but
+            their values will differ slightly from a full-precision run.
+        :param torch_compile: compile the model with `torch.compile` (PyTorch 2). Since hooks inside a compiled region
+            do not fire, only the largest submodules without any hooked layer below them are compiled, and this is
+            redone whenever the set of requested layers changes.
+        """
+        self._layer_results = OrderedDict()
+        self._hooks = OrderedDict()  # layer name -> hook handle
+        self._recording = False  # whether hooks record outputs, i.e. whether `get_activations` is running
+        # page-locked host buffers that hooked outputs are copied into, re-used batch after batch in hook call order
+        # and released once an extraction is done
+        self._staging_buffers = []
+        self._staging_index = 0
+        self._channels_last = channels_last
+        self._autocast_dtype = autocast_dtype
+        self._torch_compile = torch_compile
+        self._eager_forwards = {}  # compiled module -> its forward before compilation
+        super(PytorchWrapper, self).__init__(*args, **kwargs)
+        import torch
+        if torch_compile and not hasattr(torch, 'compile'):
+            raise ValueError(f"torch_compile requires PyTorch 2, but torch {torch.__version__} is installed")
+        if autocast_dtype == torch.float16 and self._device.type != 'cuda':
+            # CPU autocast would warn and silently run in float32 instead
+            raise ValueError("float16 autocast is only supported on CUDA, use torch.bfloat16 on the CPU")
+        if channels_last:
+            self._model = self._model.to(memory_format=torch.channels_last)
+        # device -> host copies of hooked outputs run on their own stream, overlapping with the rest of the forward pass
+        self._copy_stream = torch.cuda.Stream(self._device) if self._device.type == 'cuda' else None
+
+    def __call__(self, *args, **kwargs):
+        try:
+            return super(PytorchWrapper, self).__call__(*args, **kwargs)
+        finally:
+            self._staging_buffers = []  # page-locked memory is scarce, only hold on to it while extracting
+
+    def get_activations(self, images, layer_names):
+        import torch
+        if isinstance(images, np.ndarray):  # already batched by the numpy preprocessing, share its memory
+            images = torch.from_numpy(np.ascontiguousarray(images))
+        elif not torch.is_tensor(images):
+            images = torch.stack([image if torch.is_tensor(image) else torch.from_numpy(image) for image in images])
+        images = images.to(self._device, non_blocking=True)
+        if self._channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        self._model.eval()
+
+        self._attach_hooks(layer_names)
+        self._layer_results.clear()
+        self._staging_index = 0
+        # activations are only read out, no need to record them for autograd
+        autocast = torch.autocast(self._device.type, dtype=self._autocast_dtype,
+                                  enabled=self._autocast_dtype is not None)
+        try:
+            self._recording = True
+            try:
+                with torch.inference_mode(), autocast:
+                    self._model(images)
+            finally:
+                self._recording = False
+            missing_layers = self._missing_layers(layer_names)
+            assert not missing_layers, f"No output recorded for layers {missing_layers}, were their modules bypassed?"
+        except BaseException:
+            # hooks are only kept for the next batch after a successful pass
+            self._detach_hooks()
+            raise
+        if self._copy_stream is not None:  # wait for the asynchronous copies started in the hooks
+            self._copy_stream.synchronize()
+        del self._staging_buffers[self._staging_index:]  # not needed for this set of layers
+        layer_results = OrderedDict((layer_name, self._to_numpy(output))
+                                    for layer_name, output in self._layer_results.items())
+        self._layer_results.clear()
+        return layer_results
+
+    def _missing_layers(self, layer_names):
+        return [layer_name for layer_name in layer_names if layer_name not in self._layer_results]
+
+    @classmethod
+    def _to_numpy(cls, output):
+        import torch
+        # autocast outputs are copied to the host in reduced precision to save bytes, but handed on as float32
+        if output.dtype in [torch.float16, torch.bfloat16]:
+            return output.float().numpy()
+        if output.is_pinned():  # staging buffers are overwritten by the next batch, hand out a pageable copy
+            return output.numpy().copy()
+        return output.numpy()
+
+    def _attach_hooks(self, layer_names):
+        layer_names = list(OrderedDict.fromkeys(layer_names))  # hook every layer once, even if requested repeatedly
+        if list(self._hooks) == layer_names:
+            return
+        self._detach_hooks()
+        hooked_layers = set()
+        for layer_name in layer_names:
+            layer = self.get_layer(layer_name)
+            self._hooks[layer_name] = self.register_hook(layer, layer_name, target_dict=self._layer_results)
+            hooked_layers.add(layer)
+        if self._torch_compile:
+            self._compile_around(hooked_layers)
+
+    def remove_hooks(self):
+        """
+        Removes the forward hooks kept on the model from previous `get_activations` calls and releases the host
+        buffers activations are staged in. Both are re-created by the next call.
+        """
+        self._detach_hooks()
+        self._staging_buffers = []
+
+    def _detach_hooks(self):
+        for hook in self._hooks.values():
+            hook.remove()  # no-op for handles shared between multiple layer names
+        self._hooks.clear()
+        self._restore_eager_forwards()
+
+    def _compile_around(self, hooked_layers):
+        import torch
+        contains_hooks = {}
+
+        def has_hooks(module):  # whether `module` or any of its submodules is hooked
+            if module not in contains_hooks:
+                contains_hooks[module] = module in hooked_layers or any(
+                    has_hooks(submodule) for submodule in module.children())
+            return contains_hooks[module]
+
+        stack = [self._model]
+        while stack:
+            module = stack.pop()
+            submodules = list(module.children())
+            if any(has_hooks(submodule) for submodule in submodules):
+                stack.extend(submodules)
+            elif module not in self._eager_forwards:
+                # hooks of `module` itself are called outside of `forward` and thus keep firing
+                self._eager_forwards[module] = module.__dict__.get('forward')
+                module.forward = torch.compile(module.forward)
+
+    def _restore_eager_forwards(self):
+        for module, forward in self._eager_forwards.items():
+            if forward is None:
+                del module.forward  # fall back to the class' forward
+            else:
+                module.forward = forward
+        self._eager_forwards.clear()
+
+    def register_hook(self, layer, layer_name, target_dict):
+        def hook_function(_layer, _input, output, name=layer_name):
+            if not self._recording:
+                return
+            target_dict[name] = self._tensor_to_host(output)
+
+        hook = layer.register_forward_hook(hook_function)
+        return hook
+
+    def _tensor_to_host(self, output):
+        """
+        Starts a non-blocking copy of `output` into page-locked host memory on the dedicated copy stream so that the
+        forward pass is neither stalled by every hooked layer nor waits for the transfer.
+        The copy is only complete once the copy stream has been synchronized.
+        """
+        import torch
+        output = output.detach()
+        if not output.is_cuda:
+            return output
+        # snapshot on the compute stream: later (e.g. in-place) operations of the forward pass could otherwise modify
+        # `output` while it is still being copied. This device-side copy is much faster than the transfer itself.
+        output = output.clone(memory_format=torch.contiguous_format)
+        self._copy_stream.wait_stream(torch.cuda.current_stream(output.device))
+        host_output = self._staging_buffer(output)
+        with torch.cuda.stream(self._copy_stream):
+            host_output.copy_(output, non_blocking=True)
+        output.record_stream(self._copy_stream)  # do not hand the snapshot's memory out again before the copy is done
+        return host_output
+
+    def _staging_buffer(self, output):
+        """
+        :return: a page-locked host tensor shaped like `output`. Buffers are re-used across batches (and only grown
+            when an output does not fit) so that at most one batch of the requested layers' activations is kept in
+            page-locked memory, and only until the extraction is done or `remove_hooks` is called.
+        """
+        import torch
+        index = self._staging_index
+        self._staging_index += 1
+        if index == len(self._staging_buffers):
+            self._staging_buffers.append(None)
+        buffer = self._staging_buffers[index]
+        if buffer is None or buffer.dtype != output.dtype or buffer.numel() < output.numel():
+            buffer = torch.empty(output.numel(), dtype=output.dtype, pin_memory=True)
+            self._staging_buffers[index] = buffer
+        return buffer[:output.numel()].view(output.shape)
+
+    def layers(self):
+        # same leaf modules in the same order as filtering `named_modules`, but walked with an explicit stack and
+        # direct `_modules` dict access instead of nested generators
+        separator = SUBMODULE_SEPARATOR
+        visited = set()
+        stack = [('', self._model)]
+        while stack:
+            name, module = stack.pop()
+            if module in visited:
+                continue
+            visited.add(module)
+            submodules = [(subname, submodule) for subname, submodule in module.__dict__['_modules'].items()
+                          if submodule is not None]
+            if not submodules:
+                yield name, module
+                continue
+            stack.extend((name + separator + subname if name else subname, submodule)
+                         for subname, submodule in reversed(submodules))
+
+
+def default_device():
+    import torch
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def load_preprocess_images(image_filepaths, image_size, device=None, decode_on_device=False,
+                           normalize_mean=IMAGENET_MEAN, normalize_std=IMAGENET_STD):
+    """
+    Batched counterpart of `model_tools.activations.pytorch.load_preprocess_images`.
+    Instead of resizing and normalizing every image on its own with PIL, all images are stacked into one uint8 tensor
+    which is then resized and normalized on `device` in one go.
+    The resize is not bit-identical to PIL's, so activations differ slightly from the `model_tools` preprocessing.
+    This is why the base models do not use it by default: only the `-batched` base models, which have their own
+    identifiers so as to not mix with stored activations and scores, are preprocessed with it.
+    :param decode_on_device: decode JPEGs on a CUDA `device` with nvJPEG rather than on the host with PIL.
+        nvJPEG's decoded pixels differ slightly from libjpeg's, so this changes activations as well.
+    :return: a float tensor of shape (images, channels, image_size, image_size) on `device`
+    """
+    import torch
+    device = torch.device(device) if device is not None else default_device()
+    images = load_images(image_filepaths, device=device, decode_on_device=decode_on_device)
+    return preprocess_images(images, image_size=image_size, device=device,
+                             normalize_mean=normalize_mean, normalize_std=normalize_std)
+
+
+def load_images(image_filepaths, device, decode_on_device=False):
+    """
+    Reads and host-decodes the images on a pool of worker threads (PIL releases the GIL while decoding).
+    :return: list of HWC uint8 tensors. With `decode_on_device` and a CUDA `device`, JPEGs are decoded straight into
+        device memory with nvJPEG, all other images are decoded on the host with PIL.
+    """
+    decode_on_device = decode_on_device and device.type == 'cuda'
+    images = list(_loader_pool().map(functools.partial(_read_image, decode_on_device=decode_on_device),
+                                     image_filepaths))
+    # device decoding stays on the calling thread
+    for i, (image_filepath, image) in enumerate(zip(image_filepaths, images)):
+        if image.dim() == 1:  # raw JPEG bytes
+            try:
+                images[i] = _decode_jpeg(image, device=device)
+            except RuntimeError:  # formats nvJPEG does not support, e.g. CMYK
+                images[i] = _load_host_image(image_filepath)
+    return images
+
+
+@functools.lru_cache(maxsize=None)
+def _loader_pool():
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=max(1, (os.cpu_count() or 1) // 2))
+
+
+def _read_image(image_filepath, decode_on_device):
+    """
+    :return: the raw file bytes as a 1D uint8 tensor for JPEGs that will be decoded on the device,
+        otherwise the decoded HWC uint8 image
+    """
+    image_filepath = str(image_filepath)
+    if decode_on_device and os.path.splitext(image_filepath)[1].lower() in ['.jpg', '.jpeg']:
+        from torchvision.io import read_file
+        data = read_file(image_filepath)
+        if data[:2].tolist() == [0xFF, 0xD8]:  # JPEG start-of-image marker, the extension alone can be wrong
+            return data
+    return _load_host_image(image_filepath)
+
+
+def _load_host_image(image_filepath):
+    import torch
+    # `load_image` converts grayscale and palette images only, but e.g. CMYK images need to become RGB as well
+    return torch.from_numpy(np.array(load_image(str(image_filepath)).convert('RGB')))
+
+
+def _decode_jpeg(data, device):
+    from torchvision.io import decode_jpeg, ImageReadMode
+    image = decode_jpeg(data, mode=ImageReadMode.RGB, device=device)
+    return image.permute(1, 2, 0)  # CHW -> HWC
+
+
+def preprocess_images(images, image_size, device=None, normalize_mean=IMAGENET_MEAN, normalize_std=IMAGENET_STD):
+    """
+    :param images: list of HWC images, either uint8 tensors on the host or on `device`, or float arrays in [0, 1].
+        The float arrays are used as they are instead of being quantized to uint8 and back.
+    """
+    import torch
+    device = torch.device(device) if device is not None else default_device()
+    images = [torch.from_numpy(np.ascontiguousarray(image)) if isinstance(image, np.ndarray) else image
+              for image in images]
+    if len(set(image.shape for image in images)) == 1:  # equally sized images can be resized as one batch
+        images = _resize(_stack_on_device(images, device).permute(0, 3, 1, 2), image_size)
+    else:
+        images = torch.cat([_resize(image.to(device, non_blocking=True).permute(2, 0, 1).unsqueeze(0), image_size)
+                            for image in images])
+    mean, std = _normalization(tuple(normalize_mean), tuple(normalize_std), device)
+    return images.sub_(mean).div_(std)
+
+
+def _stack_on_device(images, device):
+    import torch
+    if any(image.is_cuda for image in images):  # at least partially decoded on the device already
+        return torch.stack([image.to(device, non_blocking=True) for image in images])
+    images = torch.stack(images)
+    if device.type == 'cuda':
+        images = images.pin_memory()
+    return images.to(device, non_blocking=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _normalization(normalize_mean, normalize_std, device):
+    # built once per device and re-used for every batch
+    import torch
+    mean = torch.tensor(normalize_mean, device=device).view(1, -1, 1, 1)
+    std = torch.tensor(normalize_std, device=device).view(1, -1, 1, 1)
+    return mean, std
+
+
+def _resize(images, image_size):
+    import torch
+    from torch.nn import functional as F
+    images = images.float().div_(255) if images.dtype == torch.uint8 else images.float()
+    # antialias to stay close to the PIL resize used by `model_tools`
+    return F.interpolate(images, size=(image_size, image_size), mode='bilinear', align_corners=False, antialias=True)
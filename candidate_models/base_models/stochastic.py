@@ -1,5 +1,5 @@
 
-from model_tools.activations.pytorch import PytorchWrapper
+from candidate_models.base_models.pytorch import PytorchWrapper
 from model_tools.activations.core import ActivationsExtractorHelper
 from candidate_models.base_models.cornet import TemporalPytorchWrapper, TemporalExtractor
 
@@ -18,7 +18,7 @@ from model_tools.activations.tensorflow import TensorflowSlimWrapper
 from model_tools.activations.tensorflow import load_resize_image
 from model_tools.activations.pytorch import load_images
 from model_tools.activations.pytorch import load_preprocess_images
-from model_tools.activations.pytorch import PytorchWrapper
+from candidate_models.base_models.pytorch import PytorchWrapper
 
 _logger = logging.getLogger(__name__)
 
@@ -245,8 +245,8 @@ class ModelBuilder:
             images = torch.from_numpy(images)
             if torch.cuda.is_available():
                 images = images.cuda()
-            images = torch.autograd.Variable(images)
-            images = sobel_filter(images)
+            with torch.inference_mode():
+                images = sobel_filter(images)
             images = images.float().to(device).numpy()
             return images
 
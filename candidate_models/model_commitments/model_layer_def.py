@@ -315,3 +315,7 @@ for version, multiplier, image_size in [
         model_layers[identifier] = mobilenet_v1()
     else:
         model_layers[identifier] = mobilenet_v2()
+
+# same layers for the models registered with batched preprocessing, see `base_models.BATCHED_PREPROCESSING_MODELS`
+for identifier in ['alexnet', 'vgg-16-pt', 'resnet-18-pt', 'resnet-50-pt', 'resnet-101-pt', 'densenet-121-pt']:
+    model_layers[f"{identifier}-batched"] = model_layers[identifier]
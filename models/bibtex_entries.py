@@ -1,19 +1,16 @@
 import csv
+import functools
 import os
 
-entries = {}
 
+@functools.lru_cache(maxsize=None)
+def _load_entries():
+    # the csv is read once per process, later lookups only hit the resulting dict
+    with open(f'{os.path.dirname(__file__)}/../candidate_models/base_models/models.csv') as refs:
+        csv_reader = csv.reader(refs, delimiter=',')
+        next(csv_reader)  # skip header
+        return {row[0]: row[2] for row in csv_reader}
 
-def find_entry(model):
-    if len(entries) == 0:
-        with open(f'{os.path.dirname(__file__)}/../candidate_models/base_models/models.csv') as refs:
-            csv_reader = csv.reader(refs, delimiter=',')
-            line_count = 0
-            for row in csv_reader:
-                if line_count > 0:
-                    entries[row[0]] = row[2]
-                line_count += 1
 
-    if model in entries:
-        return entries[model]
-    return ''
+def find_entry(model):
+    return _load_entries().get(model, '')
@@ -1,4 +1,4 @@
-from models.bibtex_entries import entries
+from models.bibtex_entries import find_entry
 
 from candidate_models.model_commitments import cornet_brain_pool
 from model_tools.check_submission import check_models
@@ -8,9 +8,7 @@ Template module for a brain model submission to brain-score
 """
 
 def get_bibtex(model_identifier):
-    if model_identifier in entries:
-        return entries[model_identifier]
-    return ''
+    return find_entry(model_identifier)
 
 
 def get_model_list():
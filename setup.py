@@ -15,7 +15,8 @@ requirements = [
     "networkx==1.11",
     "tqdm",
     "gitpython",
-    "torch",
+    "torch>=1.11",
+    "torchvision>=0.12",
     "keras==2.3.1",
     "tensorflow==1.15",
     "Pillow",
@@ -11,3 +11,16 @@ def test_no_time_separation():
     layers = ['IT.output-t0', 'IT.output-t1']
     activations = model([stimulus_path], layers=layers)
     assert set(activations['layer'].values) == set(layers)
+
+
+def test_temporal_logits():
+    import numpy as np
+    from torch import nn
+    from candidate_models.base_models.cornet import TemporalPytorchWrapper
+
+    model = nn.Sequential(nn.Conv2d(3, 2, kernel_size=3), nn.Flatten(), nn.Linear(2 * 6 * 6, 4))
+    wrapper = TemporalPytorchWrapper(identifier='temporal-test', model=model, preprocessing=None)
+    images = np.random.rand(2, 3, 8, 8).astype(np.float32)
+    activations = wrapper.get_activations(images, ['logits'])  # recorded per timestep as `logits-t0`
+    assert list(activations) == ['logits-t0']
+    assert activations['logits-t0'].shape == (2, 4)
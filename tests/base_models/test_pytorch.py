@@ -0,0 +1,246 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from candidate_models.base_models.pytorch import PytorchWrapper, load_preprocess_images, preprocess_images
+
+RGB_IMAGE = os.path.join(os.path.dirname(__file__), 'rgb.jpg')
+
+requires_cuda = pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+
+
+def _images(num_images=2, image_size=8):
+    return np.random.rand(num_images, 3, image_size, image_size).astype(np.float32)
+
+
+def _model():
+    return nn.Sequential(OrderedDict([
+        ('conv', nn.Conv2d(3, 2, kernel_size=3)),
+        ('relu', nn.ReLU()),
+        ('flatten', nn.Flatten()),
+        ('linear', nn.Linear(2 * 6 * 6, 4)),
+    ]))
+
+
+class TestPreprocessing:
+    @pytest.mark.parametrize('image_size', [64, 224])
+    def test_close_to_model_tools(self, image_size):
+        from model_tools.activations.pytorch import load_preprocess_images as model_tools_load_preprocess_images
+        expected = model_tools_load_preprocess_images([RGB_IMAGE], image_size=image_size)
+        actual = load_preprocess_images([RGB_IMAGE], image_size=image_size, device='cpu').numpy()
+        assert actual.shape == expected.shape
+        # PIL resizes in uint8 and rounds, we resize in float: at most a few intensity levels (1 level ~ .017 after
+        # normalization) apart per pixel and much closer on average
+        difference = np.abs(actual - expected)
+        assert difference.mean() < .01
+        assert difference.max() < .1
+
+    def test_float_arrays(self):
+        images = [np.random.rand(10, 12, 3).astype(np.float32) for _ in range(2)]
+        copies = [image.copy() for image in images]
+        actual = preprocess_images(images, image_size=8, device='cpu',
+                                   normalize_mean=(0, 0, 0), normalize_std=(1, 1, 1)).numpy()
+        quantized = preprocess_images([np.round(image * 255).astype(np.uint8) for image in images], image_size=8,
+                                      device='cpu', normalize_mean=(0, 0, 0), normalize_std=(1, 1, 1)).numpy()
+        assert actual.shape == (2, 3, 8, 8)
+        assert np.abs(actual - quantized).max() < 1 / 255
+        for image, copy in zip(images, copies):  # inputs are not normalized in place
+            np.testing.assert_array_equal(image, copy)
+
+    @pytest.mark.parametrize('decode_on_device', [
+        False, pytest.param(True, marks=[pytest.mark.requires_gpu, requires_cuda])])
+    def test_cmyk(self, tmp_path, decode_on_device):
+        from PIL import Image
+        cmyk_image = str(tmp_path / 'cmyk.jpg')
+        Image.open(RGB_IMAGE).convert('CMYK').save(cmyk_image)
+        device = 'cuda' if decode_on_device else 'cpu'
+        images = load_preprocess_images([cmyk_image, RGB_IMAGE], image_size=8, device=device,
+                                        decode_on_device=decode_on_device)
+        assert images.shape == (2, 3, 8, 8)
+
+
+def test_layers_match_named_modules():
+    model = nn.Sequential(OrderedDict([
+        ('block1', _model()),
+        ('block2', nn.Sequential(nn.ReLU(), nn.Sequential(nn.Identity(), nn.ReLU()))),
+        ('pool', nn.AdaptiveAvgPool2d(1)),
+    ]))
+    wrapper = PytorchWrapper(identifier='layers-test', model=model, preprocessing=None)
+    expected = [(name, module) for name, module in model.named_modules() if len(list(module.children())) == 0]
+    assert list(wrapper.layers()) == expected
+
+
+class TestHooks:
+    def test_reused_across_calls(self):
+        model = _model()
+        wrapper = PytorchWrapper(identifier='hooks-test', model=model, preprocessing=None)
+        wrapper.get_activations(_images(), ['conv', 'linear'])
+        handles = list(wrapper._hooks.values())
+        activations = wrapper.get_activations(_images(), ['conv', 'linear'])
+        assert list(activations) == ['conv', 'linear']
+        assert list(wrapper._hooks.values()) == handles
+        assert len(model.conv._forward_hooks) == 1
+        assert len(model.linear._forward_hooks) == 1
+
+    def test_reregistered_on_new_layers(self):
+        model = _model()
+        wrapper = PytorchWrapper(identifier='hooks-test', model=model, preprocessing=None)
+        wrapper.get_activations(_images(), ['conv', 'linear'])
+        activations = wrapper.get_activations(_images(), ['relu'])
+        assert list(activations) == ['relu']
+        assert list(wrapper._hooks) == ['relu']
+        assert len(model.conv._forward_hooks) == 0
+        assert len(model.linear._forward_hooks) == 0
+        assert len(model.relu._forward_hooks) == 1
+
+    def test_ignore_other_forward_passes(self):
+        model = _model()
+        wrapper = PytorchWrapper(identifier='hooks-test', model=model, preprocessing=None)
+        wrapper.get_activations(_images(), ['conv'])
+        model(torch.from_numpy(_images()).to(wrapper._device))
+        assert len(wrapper._layer_results) == 0
+
+    def test_duplicate_layer_names(self):
+        model = _model()
+        wrapper = PytorchWrapper(identifier='hooks-test', model=model, preprocessing=None)
+        for _ in range(3):
+            activations = wrapper.get_activations(_images(), ['conv', 'linear', 'conv'])
+            assert list(activations) == ['conv', 'linear']
+            assert len(model.conv._forward_hooks) == 1
+
+    def test_removed_after_exception(self):
+
+        class Failing(nn.Module):
+            def forward(self, x):
+                raise ValueError('forward failed')
+
+        model = nn.Sequential(OrderedDict([('conv', nn.Conv2d(3, 2, kernel_size=3)), ('failing', Failing())]))
+        wrapper = PytorchWrapper(identifier='hooks-test', model=model, preprocessing=None)
+        with pytest.raises(ValueError):
+            wrapper.get_activations(_images(), ['conv'])
+        assert len(wrapper._hooks) == 0
+        assert len(model.conv._forward_hooks) == 0
+
+
+class TestGetLayer:
+    def test_shared_module(self):
+        shared = nn.ReLU()
+        model = nn.Sequential(OrderedDict([
+            ('conv', nn.Conv2d(3, 2, kernel_size=3)), ('relu1', shared), ('relu2', shared)]))
+        wrapper = PytorchWrapper(identifier='get-layer-test', model=model, preprocessing=None)
+        assert wrapper.get_layer('relu1') is shared
+        assert wrapper.get_layer('relu2') is shared
+        activations = wrapper.get_activations(_images(), ['relu2'])
+        assert activations['relu2'].shape == (2, 2, 6, 6)
+
+    def test_module_replaced_after_construction(self):
+        model = _model()
+        wrapper = PytorchWrapper(identifier='get-layer-test', model=model, preprocessing=None)
+        model.relu = nn.Tanh()
+        assert wrapper.get_layer('relu') is model.relu
+        activations = wrapper.get_activations(_images(), ['relu'])
+        assert np.all(np.abs(activations['relu']) <= 1)
+        assert len(model.relu._forward_hooks) == 1
+
+
+class TestAutocast:
+    def test_cpu_bfloat16(self, monkeypatch):
+        wrapper = PytorchWrapper(identifier='autocast-test', model=_model(), preprocessing=None,
+                                 autocast_dtype=torch.bfloat16)
+        wrapper._device = torch.device('cpu')
+        wrapper._model = wrapper._model.to(wrapper._device)
+        recorded_dtypes = []
+        to_numpy = wrapper._to_numpy
+
+        def record_dtype(output):
+            recorded_dtypes.append(output.dtype)
+            return to_numpy(output)
+
+        monkeypatch.setattr(wrapper, '_to_numpy', record_dtype)
+        activations = wrapper.get_activations(_images(), ['conv', 'linear'])
+        assert recorded_dtypes == [torch.bfloat16, torch.bfloat16]
+        assert all(activation.dtype == np.float32 for activation in activations.values())
+        assert activations['linear'].shape == (2, 4)
+
+    def test_cpu_float16_rejected(self):
+        if torch.cuda.is_available():
+            pytest.skip("float16 autocast is supported on CUDA")
+        with pytest.raises(ValueError):
+            PytorchWrapper(identifier='autocast-test', model=_model(), preprocessing=None,
+                           autocast_dtype=torch.float16)
+
+
+@pytest.mark.skipif(not hasattr(torch, 'compile'), reason="torch.compile requires PyTorch 2")
+class TestTorchCompile:
+    def test_hooked_layers_record(self):
+        model = _model()
+        wrapper = PytorchWrapper(identifier='compile-test', model=model, preprocessing=None, torch_compile=True)
+        images = _images()
+        activations = wrapper.get_activations(images, ['relu', 'linear'])
+        assert activations['relu'].shape == (2, 2, 6, 6)
+        assert activations['linear'].shape == (2, 4)
+        expected = model(torch.from_numpy(images).to(wrapper._device)).detach().cpu().numpy()
+        np.testing.assert_allclose(activations['linear'], expected, rtol=1e-4, atol=1e-5)
+
+    def test_eager_forwards_restored(self):
+        model = _model()
+        wrapper = PytorchWrapper(identifier='compile-test', model=model, preprocessing=None, torch_compile=True)
+        wrapper.get_activations(_images(), ['conv'])
+        assert model.linear in wrapper._eager_forwards
+        assert 'forward' in model.linear.__dict__  # compiled
+        wrapper.get_activations(_images(), ['linear'])
+        assert model.linear not in wrapper._eager_forwards
+        assert 'forward' not in model.linear.__dict__  # back to the class' eager forward
+        wrapper.remove_hooks()
+        assert len(wrapper._eager_forwards) == 0
+        assert all('forward' not in module.__dict__ for module in model.modules())
+
+
+@pytest.mark.requires_gpu
+@requires_cuda
+class TestStagingBuffers:
+    def test_bounded_across_calls(self):
+        model = _model()
+        wrapper = PytorchWrapper(identifier='staging-test', model=model, preprocessing=None)
+        for _ in range(3):
+            wrapper.get_activations(_images(), ['conv', 'linear'])
+            model(torch.from_numpy(_images()).to(wrapper._device))  # outside of the wrapper, must not stage anything
+            assert len(wrapper._staging_buffers) == 2
+        wrapper.get_activations(_images(), ['conv'])
+        assert len(wrapper._staging_buffers) == 1
+        wrapper.remove_hooks()
+        assert len(wrapper._staging_buffers) == 0
+
+    def test_same_as_synchronous_copies(self):
+        # the in-place ReLU overwrites the hooked convolution's output while it is still being copied to the host
+        model = nn.Sequential(OrderedDict([
+            ('conv', nn.Conv2d(3, 16, kernel_size=3, padding=1)),
+            ('relu', nn.ReLU(inplace=True)),
+            ('conv2', nn.Conv2d(16, 16, kernel_size=3, padding=1)),
+            ('flatten', nn.Flatten()),
+        ]))
+        wrapper = PytorchWrapper(identifier='staging-test', model=model, preprocessing=None)
+        for _ in range(3):
+            images = _images(num_images=8, image_size=64)
+            activations = wrapper.get_activations(images, ['conv', 'conv2'])
+
+            expected = {}
+
+            def synchronous_hook(name):
+                def hook(_layer, _input, output):
+                    expected[name] = output.detach().cpu().numpy()
+                return hook
+
+            handles = [model.conv.register_forward_hook(synchronous_hook('conv')),
+                       model.conv2.register_forward_hook(synchronous_hook('conv2'))]
+            with torch.no_grad():
+                model(torch.from_numpy(images).to(wrapper._device))
+            for handle in handles:
+                handle.remove()
+            assert (expected['conv'] < 0).any()  # otherwise the in-place ReLU would not change anything
+            for layer in ['conv', 'conv2']:
+                np.testing.assert_allclose(activations[layer], expected[layer], rtol=1e-4, atol=1e-5)